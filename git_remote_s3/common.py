@@ -2,10 +2,161 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import re
 
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
 from .enums import UriScheme
 
+MB = 1024 * 1024
+MIN_PART_SIZE = 8 * MB
+MAX_PART_SIZE = 512 * MB
+# S3 allows at most 10,000 parts per multipart upload
+MAX_PARTS = 10000
+# S3 deletes at most 1,000 keys per DeleteObjects request
+MAX_DELETE_KEYS = 1000
+
+# A single client is shared by all the threads of a process. Its connections are
+# reused instead of paying a new TLS handshake for each request, as long as the
+# requests in flight fit in the pool: concurrent transfers split it between them,
+# see get_max_concurrency.
+# Requests are sent over TLS, skip hashing the whole body to sign it.
+MAX_POOL_CONNECTIONS = 64
+S3_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+    s3={"payload_signing_enabled": False},
+)
+
+# Objects are checksummed with CRC32, computed by zlib, instead of MD5
+UPLOAD_EXTRA_ARGS = {"ChecksumAlgorithm": "CRC32"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(profile: str = None) -> boto3.Session:
+    """Gets the boto3 session of a profile, created once per process
+
+    Creating a session resolves the profile configuration and loads the botocore
+    data files, the session is reused by all the clients of the process.
+
+    Args:
+        profile (str): the AWS profile or None for the default credential chain
+
+    Returns:
+        boto3.Session: the session
+    """
+    return boto3.Session(profile_name=profile)
+
+
+def delete_keys(s3, bucket: str, keys: list[str]) -> list[dict]:
+    """Deletes objects with as few DeleteObjects requests as possible
+
+    Args:
+        s3: the S3 client
+        bucket (str): the bucket of the objects
+        keys (list[str]): the keys of the objects to delete
+
+    Returns:
+        list[dict]: the errors reported by S3 for the keys that were not deleted
+    """
+    errors = []
+    for i in range(0, len(keys), MAX_DELETE_KEYS):
+        res = s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [{"Key": k} for k in keys[i : i + MAX_DELETE_KEYS]],
+                "Quiet": True,
+            },
+        )
+        errors.extend(res.get("Errors", []))
+    return errors
+
+
+def choose_part_size(file_size: int) -> int:
+    """Chooses the multipart part size for a file
+
+    The part size grows with the file size (roughly 64 parts per file, rounded
+    to a power of two) so that small files are still uploaded in parallel while
+    multi-GB files do not pay the per-request overhead of thousands of parts.
+
+    Args:
+        file_size (int): the size of the file in bytes
+
+    Returns:
+        int: the part size in bytes
+    """
+    part_size = min(1 << max(file_size // 64 - 1, 0).bit_length(), MAX_PART_SIZE)
+    return max(MIN_PART_SIZE, part_size, -(-file_size // MAX_PARTS))
+
+
+def get_max_concurrency(transfers: int) -> int:
+    """Chooses the number of parts in flight for each of concurrent transfers
+
+    A transfer has up to 16 parts in flight at the same time, above that S3
+    starts to throttle requests on the same prefix. Concurrent transfers share
+    the connection pool of the client, so that together they do not open more
+    connections than the pool keeps.
+
+    Args:
+        transfers (int): the number of transfers running at the same time
+
+    Returns:
+        int: the number of parts in flight for each transfer
+    """
+    return max(1, min(16, MAX_POOL_CONNECTIONS // transfers))
+
+
+def get_transfer_config(file_size: int, transfers: int = 1) -> TransferConfig:
+    """Builds the s3transfer configuration to upload a file
+
+    Files are split in parts uploaded concurrently.
+
+    Args:
+        file_size (int): the size of the file in bytes
+        transfers (int): the number of transfers running at the same time
+
+    Returns:
+        TransferConfig: the transfer configuration
+    """
+    return TransferConfig(
+        multipart_threshold=MIN_PART_SIZE,
+        multipart_chunksize=choose_part_size(file_size),
+        max_concurrency=get_max_concurrency(transfers),
+        use_threads=True,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_download_config(transfers: int = 1) -> TransferConfig:
+    """Builds the s3transfer configuration to download a file
+
+    Downloads larger than the threshold are split by s3transfer in ranged GETs
+    issued concurrently. The object size is only known once s3transfer has sent
+    its own HEAD request, hence the fixed range size.
+
+    Args:
+        transfers (int): the number of transfers running at the same time
+
+    Returns:
+        TransferConfig: the transfer configuration
+    """
+    return TransferConfig(
+        multipart_threshold=MIN_PART_SIZE,
+        multipart_chunksize=64 * MB,
+        max_concurrency=get_max_concurrency(transfers),
+        use_threads=True,
+    )
+
+
+DOWNLOAD_TRANSFER_CONFIG = get_download_config(1)
+
+
+_GIT_URL_RE = re.compile(r"(s3|s3\+zip)://([^@]+@)?([a-z0-9][a-z0-9\.-]{2,62})/?(.+)?")
+
 
 def parse_git_url(url: str) -> tuple[UriScheme, str, str, str]:
     """Parses the elements in a s3:// remote origin URI
@@ -19,7 +170,7 @@ def parse_git_url(url: str) -> tuple[UriScheme, str, str, str]:
     """
     if url is None:
         return None, None, None, None
-    m = re.match(r"(s3|s3\+zip)://([^@]+@)?([a-z0-9][a-z0-9\.-]{2,62})/?(.+)?", url)
+    m = _GIT_URL_RE.match(url)
     if m is None or len(m.groups()) != 4:
         return None, None, None, None
     uri_scheme, profile, bucket, prefix = m.groups()
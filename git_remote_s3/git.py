@@ -126,11 +126,10 @@ def get_remote_url(remote: str) -> str:
 
 # validate refname according to
 # https://github.com/git/git/blob/406f326d271e0bacecdb00425422c5fa3f314930/refs.c#L170
+_INVALID_REF_NAME_RE = re.compile(
+    r"(^\.)|(\.\.)|([:\?\[\\\^\~\s\*\]])|(\.lock$)|(/$)|(@\{)|([\x00-\x1f])"
+)
+
+
 def validate_ref_name(name: str) -> bool:
-    return (
-        re.search(
-            r"(^\.)|(\.\.)|([:\?\[\\\^\~\s\*\]])|(\.lock$)|(/$)|(@\{)|([\x00-\x1f])",
-            name,
-        )
-        is None
-    )
+    return _INVALID_REF_NAME_RE.search(name) is None
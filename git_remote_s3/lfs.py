@@ -4,12 +4,22 @@
 
 import sys
 import logging
+import collections
 import json
 import subprocess
-import boto3
+from botocore.exceptions import ClientError
 import threading
+import time
 import os
-from .common import parse_git_url
+from .common import (
+    parse_git_url,
+    MB,
+    DOWNLOAD_TRANSFER_CONFIG,
+    S3_CONFIG,
+    UPLOAD_EXTRA_ARGS,
+    get_session,
+    get_transfer_config,
+)
 from .git import validate_ref_name
 
 if "lfs" in __name__:
@@ -23,22 +33,50 @@ logger = logging.getLogger(__name__)
 
 
 class ProgressPercentage:
+    # s3transfer invokes the callback for every few KiB sent, report the
+    # progress to git-lfs at most every 4 MiB or every 250 ms
+    REPORT_BYTES = 4 * MB
+    REPORT_INTERVAL = 0.25
+
     def __init__(self, oid: str):
         self._seen_so_far = 0
+        self._last_reported = 0
+        self._last_report_time = time.monotonic()
+        # bytes reported by the transfer threads, appending to a deque is
+        # thread safe so callbacks never wait for each other
+        self._pending = collections.deque()
         self._lock = threading.Lock()
         self.oid = oid
+        # the event only changes in the byte counters, encode the rest once
+        self._event_prefix = f'{{"event": "progress", "oid": {json.dumps(oid)}'
 
     def __call__(self, bytes_amount):
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            progress_event = {
-                "event": "progress",
-                "oid": self.oid,
-                "bytesSoFar": self._seen_so_far,
-                "bytesSinceLast": bytes_amount,
-            }
-            sys.stdout.write(f"{json.dumps(progress_event)}\n")
-            sys.stdout.flush()
+        self._pending.append(bytes_amount)
+        # if another thread is already accounting for the progress, the bytes
+        # are picked up by that thread: it checks for pending bytes again once
+        # it has released the lock
+        while self._pending and self._lock.acquire(blocking=False):
+            try:
+                self._report()
+            finally:
+                self._lock.release()
+
+    def _report(self):
+        while self._pending:
+            self._seen_so_far += self._pending.popleft()
+        now = time.monotonic()
+        if (
+            self._seen_so_far - self._last_reported < self.REPORT_BYTES
+            and now - self._last_report_time < self.REPORT_INTERVAL
+        ):
+            return
+        sys.stdout.write(
+            f'{self._event_prefix}, "bytesSoFar": {self._seen_so_far}, '
+            f'"bytesSinceLast": {self._seen_so_far - self._last_reported}}}\n'
+        )
+        self._last_reported = self._seen_so_far
+        self._last_report_time = now
+        sys.stdout.flush()
 
 
 def write_error_event(*, oid: str, error: str, flush=False):
@@ -73,32 +111,44 @@ class LFSProcess:
     def init_s3_bucket(self):
         if self.s3_bucket is not None:
             return
-        if self.profile is None:
-            session = boto3.Session()
-        else:
-            session = boto3.Session(profile_name=self.profile)
-        s3 = session.resource("s3")
+        s3 = get_session(self.profile).resource("s3", config=S3_CONFIG)
         self.s3_bucket = s3.Bucket(self.bucket)
 
+    def object_exists(self, key: str) -> bool:
+        """Checks if an object exists in the bucket with a single HEAD request
+
+        Args:
+            key (str): the key of the object
+
+        Returns:
+            bool: true if the object exists
+        """
+        try:
+            self.s3_bucket.meta.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise e
+
     def upload(self, event: dict):
         logger.debug("upload")
         try:
             self.init_s3_bucket()
-            if list(
-                self.s3_bucket.objects.filter(
-                    Prefix=f"{self.prefix}/lfs/{event['oid']}"
-                )
-            ):
+            if self.object_exists(f"{self.prefix}/lfs/{event['oid']}"):
                 logger.debug("object already exists")
                 sys.stdout.write(
                     f"{json.dumps({'event': 'complete', 'oid': event['oid']})}\n"
                 )
                 sys.stdout.flush()
                 return
+            file_size = os.path.getsize(event["path"])
             self.s3_bucket.upload_file(
                 event["path"],
                 f"{self.prefix}/lfs/{event['oid']}",
+                ExtraArgs=UPLOAD_EXTRA_ARGS,
                 Callback=ProgressPercentage(event["oid"]),
+                Config=get_transfer_config(file_size),
             )
             sys.stdout.write(
                 f"{json.dumps({'event': 'complete', 'oid': event['oid']})}\n"
@@ -117,6 +167,7 @@ class LFSProcess:
                 Key=f"{self.prefix}/lfs/{event['oid']}",
                 Filename=f"{temp_dir}/{event['oid']}",
                 Callback=ProgressPercentage(event["oid"]),
+                Config=DOWNLOAD_TRANSFER_CONFIG,
             )
             done_event = {
                 "event": "complete",
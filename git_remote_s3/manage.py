@@ -2,8 +2,8 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
 from .remote import parse_git_url
+from .common import S3_CONFIG, delete_keys, get_session
 import argparse
 import sys
 import uuid
@@ -22,7 +22,7 @@ class Doctor:
         self.bucket = bucket
         self.prefix = prefix
         self.delete_bundle = delete_bundle
-        self.s3 = boto3.Session(profile_name=profile).client("s3")
+        self.s3 = get_session(profile).client("s3", config=S3_CONFIG)
 
     def run(self):
         repos = self.analyze_repo()
@@ -97,14 +97,12 @@ class Doctor:
                     sha = bundles[i - 1]["sha"]
                     print(f"Keeping {sha}")
                     input("Press enter to confirm or Ctrl+C to cancel")
+                    keys_to_delete = []
                     for s in [sha["sha"] for sha in bundles]:
                         if s != sha:
+                            keys_to_delete.append(f"{self.prefix}/{ref}/{s}.bundle")
                             if self.delete_bundle:
                                 print(f"Removing {s}")
-                                self.s3.delete_object(
-                                    Bucket=self.bucket,
-                                    Key=f"{self.prefix}/{ref}/{s}.bundle",
-                                )
                             else:
                                 tmp_branch = f"{ref}_{str(uuid.uuid4())[:8]}"
                                 print(f"Moving {s} to new branch {tmp_branch}")
@@ -116,10 +114,8 @@ class Doctor:
                                     Bucket=self.bucket,
                                     Key=f"{self.prefix}/{tmp_branch}/{s}.bundle",
                                 )
-                                self.s3.delete_object(
-                                    Bucket=self.bucket,
-                                    Key=f"{self.prefix}/{ref}/{s}.bundle",
-                                )
+                    for e in delete_keys(self.s3, self.bucket, keys_to_delete):
+                        print(f"Cannot delete {e['Key']}: {e['Message']}")
                     break
             except ValueError:
                 print("Invalid input")
@@ -149,7 +145,7 @@ class ManageBranch:
     def __init__(self, profile, bucket, prefix, branch) -> None:
         self.bucket = bucket
         self.prefix = prefix
-        self.s3 = boto3.Session(profile_name=profile).client("s3")
+        self.s3 = get_session(profile).client("s3", config=S3_CONFIG)
         self.branch = branch
         if not self.get_branch_content():
             raise ValueError(f"Branch {self.branch} does not exist")
@@ -166,9 +162,11 @@ class ManageBranch:
         objs = self.get_branch_content()
         resp = input(f"Delete {self.branch} branch [yes/no]: ")
         if resp.lower() == "yes":
-            for o in objs:
-                self.s3.delete_object(Bucket=self.bucket, Key=o["Key"])
-            print(f"Branch {self.branch} has been deleted")
+            errors = delete_keys(self.s3, self.bucket, [o["Key"] for o in objs])
+            for e in errors:
+                print(f"Cannot delete {e['Key']}: {e['Message']}")
+            if not errors:
+                print(f"Branch {self.branch} has been deleted")
         else:
             print("Aborted")
 
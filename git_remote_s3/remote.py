@@ -4,6 +4,8 @@
 
 import sys
 import logging
+import concurrent.futures
+import functools
 import boto3
 import boto3.exceptions
 from botocore.exceptions import (
@@ -14,17 +16,30 @@ from botocore.exceptions import (
     UnknownCredentialError,
 )
 import re
+import shutil
 import tempfile
+import threading
 import os
 from git_remote_s3 import git
 from .enums import UriScheme
-from .common import parse_git_url
+from .common import (
+    parse_git_url,
+    S3_CONFIG,
+    UPLOAD_EXTRA_ARGS,
+    delete_keys,
+    get_download_config,
+    get_session,
+    get_transfer_config,
+)
 import botocore
 
 logger = logging.getLogger(__name__)
 if "remote" in __name__:
     logging.basicConfig(level=logging.ERROR, stream=sys.stderr)
 
+# <refs>/<type>/<name>/<sha>.bundle, the ref name can contain slashes
+_BUNDLE_KEY_RE = re.compile(r"(?P<ref>[^/]+/[^/]+/.+)/(?P<sha>[a-f0-9]{40})\.bundle")
+
 
 class BucketNotFoundError(Exception):
     def __init__(self, bucket):
@@ -43,68 +58,92 @@ class S3Remote:
         self.profile = profile
         self.bucket = bucket
         self.prefix = prefix
-        if profile:
-            self.session = boto3.Session(profile_name=profile)
-        else:
-            self.session = boto3.Session()
-        self.s3 = self.session.client("s3")
-        try:
-            self.s3.head_bucket(Bucket=bucket)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "404":
-                raise BucketNotFoundError(bucket)
-            raise e
-        self.bucket = bucket
+        self.head_key = f"{prefix}/HEAD"
+        self.session = get_session(profile or None)
+        # A missing bucket is reported by the first request sent to it, see main
+        self.s3 = self.session.client("s3", config=S3_CONFIG)
         self.mode = None
-        self.fetched_refs = []
+        self.fetched_refs = set()
+        self.fetched_refs_lock = threading.Lock()
+        self.fetch_cmds = []
         self.push_cmds = []
+        self.remote_head_lock = threading.Lock()
+        self.remote_head_exists = False
+        # sizes of the bundles listed by git before it fetches them, by key
+        self.bundle_sizes = {}
+
+    @functools.cached_property
+    def list_paginator(self):
+        # paginators are built from the service model, build it once
+        return self.s3.get_paginator("list_objects_v2")
 
     def list_refs(self, *, bucket: str, prefix: str) -> list:
-        res = self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        contents = res.get("Contents", [])
-        next_token = res.get("NextContinuationToken", None)
-
-        while next_token:
-            res = self.s3.list_objects_v2(
-                Bucket=bucket, Prefix=prefix, ContinuationToken=next_token
-            )
-            contents.extend(res.get("Contents", []))
-            next_token = res.get("NextContinuationToken", None)
-
-        contents.sort(key=lambda x: x["LastModified"])
-        contents.reverse()
-
-        objs = [
-            o["Key"].removeprefix(prefix)[1:]
-            for o in contents
-            if o["Key"].startswith(prefix + "/refs") and o["Key"].endswith(".bundle")
+        # Only list under refs/ so that LFS objects stored under the same prefix
+        # are not paged through
+        refs_prefix = f"{prefix}/refs/"
+        contents = [
+            o
+            for page in self.list_paginator.paginate(Bucket=bucket, Prefix=refs_prefix)
+            for o in page.get("Contents", [])
+            if o["Key"].endswith(".bundle")
         ]
+        contents.sort(key=lambda x: x["LastModified"], reverse=True)
+        self.bundle_sizes.update((o["Key"], o.get("Size", 0)) for o in contents)
+
+        objs = [o["Key"].removeprefix(prefix)[1:] for o in contents]
         return objs
 
-    def cmd_fetch(self, args: str):
+    def cmd_fetch(self, args: str, *, transfers: int = 1):
         sha, ref = args.split(" ")[1:]
-        if sha in self.fetched_refs:
-            return
-        logger.info(f"fetch {sha} {ref}")
-        try:
-            obj = self.s3.get_object(
-                Bucket=self.bucket, Key=f"{self.prefix}/{ref}/{sha}.bundle"
-            )
-            data = obj["Body"].read()
-
-            temp_dir = tempfile.mkdtemp(prefix="git_remote_s3_fetch_")
-            with open(f"{temp_dir}/{sha}.bundle", "wb") as f:
-                f.write(data)
-            logger.info(f"fetched {temp_dir}/{sha}.bundle {ref}")
+        with self.fetched_refs_lock:
+            if sha in self.fetched_refs:
+                return
+            self.fetched_refs.add(sha)
+        logger.info("fetch %s %s", sha, ref)
+        key = f"{self.prefix}/{ref}/{sha}.bundle"
+        config = get_download_config(transfers)
+        with tempfile.TemporaryDirectory(prefix="git_remote_s3_fetch_") as temp_dir:
+            # s3transfer sends a HEAD request to size the object before getting
+            # it, only use it for the bundles known to be large from the listing
+            # to download them with concurrent ranged GETs
+            if self.bundle_sizes.get(key, 0) >= config.multipart_threshold:
+                self.s3.download_file(
+                    self.bucket, key, f"{temp_dir}/{sha}.bundle", Config=config
+                )
+            else:
+                obj = self.s3.get_object(Bucket=self.bucket, Key=key)
+                with open(f"{temp_dir}/{sha}.bundle", "wb") as f:
+                    # stream the bundle to disk instead of holding it in memory
+                    shutil.copyfileobj(obj["Body"], f, length=1024 * 1024)
+            logger.info("fetched %s/%s.bundle %s", temp_dir, sha, ref)
 
             git.unbundle(folder=temp_dir, sha=sha, ref=ref)
-            self.fetched_refs.append(sha)
-        finally:
-            if os.path.exists(f"{temp_dir}/{sha}.bundle"):
-                os.remove(f"{temp_dir}/{sha}.bundle")
+
+    def process_fetch_cmds(self, cmds: list[str]) -> None:
+        """Fetches the bundles requested by a batch of fetch commands concurrently
+
+        Args:
+            cmds (list[str]): the fetch commands of the batch
+        """
+        # git can ask for the same sha under several refs, fetch it only once
+        unique_cmds = {}
+        for c in cmds:
+            unique_cmds.setdefault(c.split(" ")[1], c)
+        if not unique_cmds:
+            return
+        # Bound the number of concurrent downloads, each one streams its bundle
+        # to disk so memory does not grow with the size of the batch
+        workers = min(16, len(unique_cmds))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.cmd_fetch, c, transfers=workers)
+                for c in unique_cmds.values()
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
     def remove_remote_ref(self, remote_ref: str) -> str:
-        logger.info(f"Removing remote ref {remote_ref}")
+        logger.info("Removing remote ref %s", remote_ref)
         try:
             objects_to_delete = self.s3.list_objects_v2(
                 Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}"
@@ -115,37 +154,43 @@ class S3Remote:
                 or self.uri_scheme == UriScheme.S3_ZIP
                 and len(objects_to_delete) == 2
             ):
-                for object in objects_to_delete:
-                    self.s3.delete_object(Bucket=self.bucket, Key=object["Key"])
+                errors = delete_keys(
+                    self.s3, self.bucket, [o["Key"] for o in objects_to_delete]
+                )
+                if errors:
+                    logger.info("fatal: cannot delete %s\n", errors)
+                    return f'error {remote_ref} "{errors[0]["Message"]}"?\n'
                 return f"ok {remote_ref}\n"
             else:
                 return f"error {remote_ref} not found\n"
 
         except ClientError as e:
             if e.response["Error"]["Code"] == "404":
-                logger.info(f"fatal: {remote_ref} not found\n")
+                logger.info("fatal: %s not found\n", remote_ref)
                 return f"error {remote_ref} not found\n"
             raise e
 
-    def cmd_push(self, args: str) -> str:
+    def cmd_push(  # noqa: C901
+        self, args: str, *, init_head: bool = True, transfers: int = 1
+    ) -> str:
         force_push = False
         local_ref, remote_ref = args.split(" ")[1].split(":")
         if not local_ref:
             return self.remove_remote_ref(remote_ref)
+        contents, protected = self.list_ref_objects(remote_ref)
         if local_ref.startswith("+"):
-            force_push = not self.is_protected(remote_ref)
-            logger.info(f"Force push {force_push}")
+            force_push = not protected
+            logger.info("Force push %s", force_push)
             local_ref = local_ref[1:]
 
-        logger.info(f"push !{local_ref}! !{remote_ref}!")
-        temp_dir = tempfile.mkdtemp(prefix="git_remote_s3_push_")
+        logger.info("push !%s! !%s!", local_ref, remote_ref)
 
-        contents = self.get_bundles_for_ref(remote_ref)
         if len(contents) > 1:
             return f'error {remote_ref} "multiple bundles exists on server. Run git-s3 doctor to fix."?\n'  # noqa: B950
 
         remote_to_remove = contents[0]["Key"] if len(contents) == 1 else None
 
+        temp_dir = None
         try:
             sha = git.rev_parse(local_ref)
             if remote_to_remove:
@@ -153,44 +198,71 @@ class S3Remote:
                 if not force_push and not git.is_ancestor(remote_sha, sha):
                     return f'error {remote_ref} "remote ref is not ancestor of {local_ref}."?\n'
 
+            # the bundle is only created once the push is known to be accepted
+            temp_dir = tempfile.mkdtemp(prefix="git_remote_s3_push_")
             temp_file = git.bundle(folder=temp_dir, sha=sha, ref=local_ref)
 
-            with open(temp_file, "rb") as f:
-                self.s3.put_object(
-                    Bucket=self.bucket,
-                    Key=f"{self.prefix}/{remote_ref}/{sha}.bundle",
-                    Body=f,
+            # Create a zip archive to push next to the bundle file while the
+            # bundle is being uploaded. Leaving the block waits for the archive,
+            # also when the upload fails, before the folder is removed.
+            # Example use-case: Repo on S3 as Source for AWS CodePipeline
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                archive = None
+                if self.uri_scheme == UriScheme.S3_ZIP:
+                    archive = executor.submit(
+                        git.archive, folder=temp_dir, ref=local_ref
+                    )
+
+                self.upload_file(
+                    temp_file, f"{self.prefix}/{remote_ref}/{sha}.bundle", transfers
                 )
-            self.init_remote_head(remote_ref)
-            logger.info(f"pushed {temp_file} to {remote_ref}")
-            if remote_to_remove:
-                self.s3.delete_object(Bucket=self.bucket, Key=remote_to_remove)
-
-            if self.uri_scheme == UriScheme.S3_ZIP:
-                # Create and push a zip archive next to the bundle file
-                # Example use-case: Repo on S3 as Source for AWS CodePipeline
-                temp_file_archive = git.archive(folder=temp_dir, ref=local_ref)
-                with open(temp_file_archive, "rb") as f:
-                    self.s3.put_object(
-                        Bucket=self.bucket,
-                        Key=f"{self.prefix}/{remote_ref}/repo.zip",
-                        Body=f,
+                if init_head:
+                    self.init_remote_head(remote_ref)
+                logger.info("pushed %s to %s", temp_file, remote_ref)
+                if remote_to_remove:
+                    self.s3.delete_object(Bucket=self.bucket, Key=remote_to_remove)
+
+                if archive is not None:
+                    temp_file_archive = archive.result()
+                    self.upload_file(
+                        temp_file_archive,
+                        f"{self.prefix}/{remote_ref}/repo.zip",
+                        transfers,
+                    )
+                    logger.info(
+                        "pushed %s to %s/repo.zip", temp_file_archive, remote_ref
                     )
-                logger.info(f"pushed {temp_file_archive} to {remote_ref}/repo.zip")
 
             return f"ok {remote_ref}\n"
         except git.GitError:
-            logger.info(f"fatal: {local_ref} not found\n")
+            logger.info("fatal: %s not found\n", local_ref)
             return f'error {remote_ref} "{local_ref} not found"?\n'
         except boto3.exceptions.S3UploadFailedError as e:
-            logger.info(f"fatal: {e}\n")
+            logger.info("fatal: %s\n", e)
             return f'error {remote_ref} "{e}"?\n'
         except botocore.exceptions.ClientError as e:
-            logger.info(f"fatal: {e}\n")
+            logger.info("fatal: %s\n", e)
             return f'error {remote_ref} "{e}"?\n'
         finally:
-            if os.path.exists(f"{temp_dir}/{sha}.bundle"):
-                os.remove(f"{temp_dir}/{sha}.bundle")
+            # removes the bundle and the archive
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def upload_file(self, file_path: str, key: str, transfers: int = 1) -> None:
+        """Uploads a file to the remote, in concurrent parts if it is large
+
+        Args:
+            file_path (str): the path of the file to upload
+            key (str): the key of the object
+            transfers (int): the number of uploads running at the same time
+        """
+        self.s3.upload_file(
+            file_path,
+            self.bucket,
+            key,
+            ExtraArgs=UPLOAD_EXTRA_ARGS,
+            Config=get_transfer_config(os.path.getsize(file_path), transfers),
+        )
 
     def init_remote_head(self, ref: str) -> None:
         """Initialise the remote HEAD reference if it does not exist
@@ -199,40 +271,71 @@ class S3Remote:
             ref (str): The ref to which the remote HEAD should point to
         """
 
-        try:
-            self.s3.head_object(Bucket=self.bucket, Key=f"{self.prefix}/HEAD")
-        except ClientError:
-            self.s3.put_object(
-                Bucket=self.bucket,
-                Key=f"{self.prefix}/HEAD",
-                Body=ref,
-            )
+        # refs can be pushed concurrently, only the first one sets the HEAD
+        with self.remote_head_lock:
+            # once seen or written the HEAD is never removed by the remote
+            if self.remote_head_exists:
+                return
+            try:
+                self.s3.head_object(Bucket=self.bucket, Key=self.head_key)
+            except ClientError:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.head_key,
+                    Body=ref,
+                )
+            self.remote_head_exists = True
+
+    def init_remote_head_for_batch(self, cmds: list[str], results: list[str]) -> None:
+        """Initialise the remote HEAD from the first ref pushed by a batch
 
-    def get_bundles_for_ref(self, remote_ref: str) -> list[str]:
-        """Lists all the bundles for a given ref on the remote
+        The refs of a batch are pushed concurrently, the HEAD is only chosen once
+        they are all pushed so that it points to the first ref sent by git and
+        not to the first one uploaded.
+
+        Args:
+            cmds (list[str]): the push commands of the batch
+            results (list[str]): the results of the commands, updated with an
+            error if the HEAD cannot be written
+        """
+        for i, (cmd, res) in enumerate(zip(cmds, results)):
+            local_ref, remote_ref = cmd.split(" ")[1].split(":")
+            # deleted refs cannot be the HEAD
+            if not local_ref or not res.startswith("ok"):
+                continue
+            try:
+                self.init_remote_head(remote_ref)
+            except ClientError as e:
+                logger.info("fatal: %s\n", e)
+                results[i] = f'error {remote_ref} "{e}"?\n'
+            return
+
+    def list_ref_objects(self, remote_ref: str) -> tuple[list[dict], bool]:
+        """Lists the bundles of a ref on the remote and checks if it is protected
 
         Args:
             remote_ref (str): the remote ref
 
         Returns:
-            list[str]: the list of bundle keys
+            tuple[list[dict], bool]: the bundle objects and true if the ref is
+            protected
         """
 
         # We are not implementing pagination since there can be few objects (bundles)
         # under a single Prefix
-        return [
+        ref_prefix = f"{self.prefix}/{remote_ref}/"
+        contents = self.s3.list_objects_v2(Bucket=self.bucket, Prefix=ref_prefix).get(
+            "Contents", []
+        )
+        bundles = [
             c
-            for c in self.s3.list_objects_v2(
-                Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}/"
-            ).get("Contents", [])
+            for c in contents
             if "PROTECTED#" not in c["Key"] and ".zip" not in c["Key"]
         ]
-
-    def is_protected(self, remote_ref):
-        protected = self.s3.list_objects_v2(
-            Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}/PROTECTED#"
-        ).get("Contents", [])
-        return protected
+        protected = any(
+            c["Key"].startswith(f"{ref_prefix}PROTECTED#") for c in contents
+        )
+        return bundles, protected
 
     def cmd_option(self, arg: str):
         option, value = arg.split(" ")[1:]
@@ -243,29 +346,32 @@ class S3Remote:
             sys.stdout.write("unsupported\n")
         sys.stdout.flush()
 
-    def cmd_list(self, *, for_push: bool = False):
+    def cmd_list(self, args: str):
+        for_push = "for-push" in args.split(" ")[1:]
         objs = self.list_refs(bucket=self.bucket, prefix=self.prefix)
         logger.info(objs)
+        bundles = [m for m in map(_BUNDLE_KEY_RE.fullmatch, objs) if m is not None]
 
+        # the refs are sent to git with a single write, not with a write per ref
+        lines = []
         if not for_push:
             try:
                 head = self.get_remote_head()
-                logger.info(f"HEAD=[{head}]")
-                for o in objs:
-                    ref = "/".join(o.split("/")[:-1])
+                logger.info("HEAD=[%s]", head)
+                for m in bundles:
+                    ref = m["ref"]
                     if ref == head:
-                        logger.info(f"@{ref} HEAD\n")
-                        sys.stdout.write(f"@{ref} HEAD\n")
+                        logger.info("@%s HEAD\n", ref)
+                        lines.append(f"@{ref} HEAD\n")
             except ClientError as e:
                 if e.response["Error"]["Code"] == "NoSuchKey":
                     pass  # ignoring missing HEAD on remote
 
-        for o in [x for x in objs if re.match(".+/.+/.+/[a-f0-9]{40}.bundle", x)]:
-            elements = o.split("/")
-            sha = elements[-1].split(".")[0]
-            sys.stdout.write(f"{sha} {'/'.join(elements[:-1])}\n")
+        for m in bundles:
+            lines.append(f"{m['sha']} {m['ref']}\n")
 
-        sys.stdout.write("\n")
+        lines.append("\n")
+        sys.stdout.write("".join(lines))
         sys.stdout.flush()
 
     def get_remote_head(self) -> str:
@@ -275,7 +381,7 @@ class S3Remote:
             str: the remote head ref
         """
         head = (
-            self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}/HEAD")
+            self.s3.get_object(Bucket=self.bucket, Key=self.head_key)
             .get("Body")
             .read()
             .decode("utf-8")
@@ -284,47 +390,69 @@ class S3Remote:
 
         return head
 
-    def cmd_capabilities(self):
-        sys.stdout.write("*push\n")
-        sys.stdout.write("*fetch\n")
-        sys.stdout.write("option\n")
+    def cmd_capabilities(self, args: str):
+        sys.stdout.write("*push\n*fetch\noption\n\n")
+        sys.stdout.flush()
+
+    def queue_fetch(self, cmd: str):
+        if self.mode != Mode.FETCH:
+            self.mode = Mode.FETCH
+            self.fetch_cmds = []
+        self.fetch_cmds.append(cmd)
+
+    def queue_push(self, cmd: str):
+        if self.mode != Mode.PUSH:
+            self.mode = Mode.PUSH
+            self.push_cmds = []
+        self.push_cmds.append(cmd)
+
+    def process_batch(self):
+        logger.info("empty line")
+        if self.mode == Mode.PUSH and self.push_cmds:
+            logger.info("pushing %s", self.push_cmds)
+            # refs are pushed concurrently, results are reported in order
+            workers = min(len(self.push_cmds), 8)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                push_res = list(
+                    executor.map(
+                        functools.partial(
+                            self.cmd_push, init_head=False, transfers=workers
+                        ),
+                        self.push_cmds,
+                    )
+                )
+            self.init_remote_head_for_batch(self.push_cmds, push_res)
+            sys.stdout.write("".join(push_res))
+            self.push_cmds = []
+        elif self.mode == Mode.FETCH and self.fetch_cmds:
+            logger.info("fetching %s", self.fetch_cmds)
+            self.process_fetch_cmds(self.fetch_cmds)
+            self.fetch_cmds = []
         sys.stdout.write("\n")
         sys.stdout.flush()
 
-    def process_cmd(self, cmd: str):  # noqa: C901
-        if cmd.startswith("fetch"):
-            self.cmd_fetch(cmd.strip())
-        elif cmd.startswith("push"):
-            if self.mode != Mode.PUSH:
-                self.mode = Mode.PUSH
-                self.push_cmds = []
-            self.push_cmds.append(cmd.strip())
-            # self.cmd_push(cmd.strip())
-        elif cmd.startswith("option"):
-            self.cmd_option(cmd.strip())
-        elif cmd.startswith("list for-push"):
-            self.cmd_list(for_push=True)
-        elif cmd.startswith("list"):
-            self.cmd_list()
-        elif cmd.startswith("capabilities"):
-            self.cmd_capabilities()
-        elif cmd == "\n":
-            logger.info("empty line")
-            if self.mode == Mode.PUSH and self.push_cmds:
-                logger.info(f"pushing {self.push_cmds}")
-                push_res = [self.cmd_push(c) for c in self.push_cmds]
-                for res in push_res:
-                    sys.stdout.write(res)
-                self.push_cmds = []
-            sys.stdout.write("\n")
-            sys.stdout.flush()
-        else:
+    def process_cmd(self, cmd: str):
+        if cmd == "\n":
+            self.process_batch()
+            return
+        handler = self.COMMANDS.get(cmd.split(" ", 1)[0].strip())
+        if handler is None:
             sys.stderr.write(f"fatal: invalid command '{cmd}'\n")
             sys.stderr.flush()
             sys.exit(1)
+        handler(self, cmd.strip())
 
+    # handlers of the commands sent by git, by the first word of the command
+    COMMANDS = {
+        "fetch": queue_fetch,
+        "push": queue_push,
+        "option": cmd_option,
+        "list": cmd_list,
+        "capabilities": cmd_capabilities,
+    }
 
-def main():
+
+def main():  # noqa: C901
     logger.info(sys.argv)
     remote = sys.argv[2]
     uri_scheme, profile, bucket, prefix = parse_git_url(remote)
@@ -337,12 +465,14 @@ def main():
         s3remote = S3Remote(
             uri_scheme=uri_scheme, profile=profile, bucket=bucket, prefix=prefix
         )
-        while True:
-            line = sys.stdin.readline()
-            if not line:
-                break
-            logger.info(f"cmd: {line}")
-            s3remote.process_cmd(line)
+        try:
+            for line in sys.stdin:
+                logger.info("cmd: %s", line)
+                s3remote.process_cmd(line)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchBucket":
+                raise BucketNotFoundError(bucket)
+            raise e
 
     except BrokenPipeError:
         logger.info("BrokenPipeError")
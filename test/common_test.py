@@ -0,0 +1,64 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from git_remote_s3.common import (
+    MAX_DELETE_KEYS,
+    MAX_PARTS,
+    MB,
+    S3_CONFIG,
+    choose_part_size,
+    delete_keys,
+    get_max_concurrency,
+    get_session,
+)
+
+
+def test_delete_keys_batches_requests():
+    s3 = MagicMock()
+    s3.delete_objects.side_effect = [
+        {},
+        {"Errors": [{"Key": "k", "Code": "AccessDenied", "Message": "denied"}]},
+    ]
+    keys = [f"repo/refs/heads/main/{i}.bundle" for i in range(MAX_DELETE_KEYS + 1)]
+
+    errors = delete_keys(s3, "bucket", keys)
+
+    assert s3.delete_objects.call_count == 2
+    first, second = s3.delete_objects.call_args_list
+    assert len(first.kwargs["Delete"]["Objects"]) == MAX_DELETE_KEYS
+    assert second.kwargs["Delete"]["Objects"] == [{"Key": keys[-1]}]
+    assert errors == [{"Key": "k", "Code": "AccessDenied", "Message": "denied"}]
+
+
+def test_delete_keys_no_keys():
+    s3 = MagicMock()
+    assert delete_keys(s3, "bucket", []) == []
+    s3.delete_objects.assert_not_called()
+
+
+@pytest.mark.parametrize("transfers", [1, 2, 8, 16])
+def test_get_max_concurrency_fits_connection_pool(transfers):
+    assert 1 <= get_max_concurrency(transfers) <= 16
+    assert transfers * get_max_concurrency(transfers) <= S3_CONFIG.max_pool_connections
+
+
+def test_choose_part_size_small_file():
+    assert choose_part_size(0) == 8 * MB
+    assert choose_part_size(100 * MB) == 8 * MB
+
+
+def test_choose_part_size_scales_with_file_size():
+    assert choose_part_size(1024 * MB) == 16 * MB
+    assert choose_part_size(10 * 1024 * MB) == 256 * MB
+
+
+def test_choose_part_size_max_parts():
+    max_object_size = 5 * 1024 * 1024 * MB
+    part_size = choose_part_size(max_object_size)
+    assert part_size > 512 * MB
+    assert max_object_size / part_size <= MAX_PARTS
+
+
+def test_get_session_is_cached():
+    assert get_session(None) is get_session(None)
@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock, create_autospec
+
+import boto3
+import pytest
+
+from git_remote_s3 import git
+
+
+@pytest.fixture(scope="session")
+def s3_client_template():
+    # autospec a real client once, calls to operations that S3 does not have fail
+    client = boto3.Session().client("s3", region_name="us-east-1")
+    return create_autospec(client, instance=True)
+
+
+# no test reaches AWS, boto3 clients are mocked for the whole test session
+@pytest.fixture(scope="session", autouse=True)
+def mocked_session(s3_client_template):
+    client_mock = MagicMock(return_value=s3_client_template)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("boto3.Session.client", client_mock)
+        yield client_mock
+
+
+@pytest.fixture(autouse=True)
+def session_client_mock(mocked_session):
+    # the client is shared by the tests, start each one afresh
+    mocked_session.reset_mock()
+    mocked_session.return_value.reset_mock(return_value=True, side_effect=True)
+    return mocked_session
+
+
+@pytest.fixture
+def session_resource_mock(monkeypatch):
+    # the LFS agent goes through the S3 resource instead of the client
+    resource_mock = MagicMock()
+    monkeypatch.setattr("boto3.Session.resource", resource_mock)
+    return resource_mock
+
+
+@pytest.fixture(scope="session")
+def git_stub_template():
+    # calls to the git helpers are checked against their real signatures
+    stub = create_autospec(git)
+    stub.GitError = git.GitError
+    return stub
+
+
+@pytest.fixture
+def git_stub(monkeypatch, git_stub_template):
+    git_stub_template.reset_mock(return_value=True, side_effect=True)
+    monkeypatch.setattr("git_remote_s3.remote.git", git_stub_template)
+    return git_stub_template
@@ -0,0 +1,114 @@
+from botocore.exceptions import ClientError
+from git_remote_s3.common import (
+    DOWNLOAD_TRANSFER_CONFIG,
+    MB,
+    S3_CONFIG,
+    UPLOAD_EXTRA_ARGS,
+)
+from git_remote_s3.lfs import (
+    LFSProcess,
+    ProgressPercentage,
+)
+import tempfile
+import threading
+import json
+
+OID = "54238cfaaaa42dda05da0e12bf8ee3156763fa35296085ccdef63b13a87837c5"
+
+
+def test_upload_existing_object(session_resource_mock, capsys):
+    lfs_process = LFSProcess("s3://test-bucket/test_prefix")
+    s3_client = session_resource_mock.return_value.Bucket.return_value.meta.client
+    lfs_process.upload({"event": "upload", "oid": OID, "path": "/tmp/none"})
+    s3_client.head_object.assert_called_once_with(
+        Bucket="test-bucket", Key=f"test_prefix/lfs/{OID}"
+    )
+    bucket = session_resource_mock.return_value.Bucket.return_value
+    assert bucket.upload_file.call_count == 0
+    assert capsys.readouterr().out.endswith(
+        f'{{"event": "complete", "oid": "{OID}"}}\n'
+    )
+
+
+def test_upload_missing_object(session_resource_mock, capsys):
+    lfs_process = LFSProcess("s3://test-bucket/test_prefix")
+    bucket = session_resource_mock.return_value.Bucket.return_value
+    bucket.meta.client.head_object.side_effect = ClientError(
+        {"Error": {"Code": "404"}}, "head_object"
+    )
+    with tempfile.NamedTemporaryFile() as f:
+        lfs_process.upload({"event": "upload", "oid": OID, "path": f.name})
+    assert bucket.upload_file.call_count == 1
+    assert bucket.upload_file.call_args.args[1] == f"test_prefix/lfs/{OID}"
+    assert bucket.upload_file.call_args.kwargs["ExtraArgs"] == UPLOAD_EXTRA_ARGS
+    session_resource_mock.assert_called_once_with("s3", config=S3_CONFIG)
+
+
+def test_progress_is_rate_limited(monkeypatch, capsys):
+    now = [0]
+    monkeypatch.setattr("git_remote_s3.lfs.time.monotonic", lambda: now[0])
+    progress = ProgressPercentage(OID)
+    for _ in range(1024):
+        progress(8 * 1024)
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(events) == 2
+    assert events[-1]["bytesSoFar"] == 8 * MB
+    assert events[-1]["bytesSinceLast"] == 4 * MB
+
+    now[0] = 1
+    progress(1024)
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(events) == 1
+    assert events[-1]["bytesSinceLast"] == 1024
+
+
+def test_progress_keeps_bytes_sent_while_reporting(monkeypatch):
+    progress = ProgressPercentage(OID)
+    events = []
+
+    class Stdout:
+        # bytes sent by another transfer thread while an event is written
+        def write(self, line):
+            events.append(json.loads(line))
+            if len(events) == 1:
+                progress(1024)
+
+        def flush(self):
+            pass
+
+    monkeypatch.setattr("sys.stdout", Stdout())
+    progress(4 * MB)
+
+    assert events[0]["bytesSoFar"] == 4 * MB
+    assert progress._seen_so_far == 4 * MB + 1024
+
+
+def test_progress_concurrent_callbacks(capsys):
+    progress = ProgressPercentage(OID)
+
+    def transfer():
+        for _ in range(1000):
+            progress(1024)
+
+    threads = [threading.Thread(target=transfer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert progress._seen_so_far == 8 * 1000 * 1024
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert all(e["bytesSinceLast"] > 0 for e in events)
+
+
+def test_download(session_resource_mock, capsys):
+    lfs_process = LFSProcess("s3://test-bucket/test_prefix")
+    bucket = session_resource_mock.return_value.Bucket.return_value
+    lfs_process.download({"event": "download", "oid": OID})
+    assert bucket.download_file.call_count == 1
+    kwargs = bucket.download_file.call_args.kwargs
+    assert kwargs["Key"] == f"test_prefix/lfs/{OID}"
+    assert kwargs["Config"] == DOWNLOAD_TRANSFER_CONFIG
+    event = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert event["event"] == "complete"
+    assert event["path"].endswith(f"/{OID}")
@@ -1,20 +1,58 @@
-import botocore.client
-from mock import patch
 from io import StringIO, BytesIO
 from git_remote_s3 import S3Remote, UriScheme
+from git_remote_s3.git import GitError
+from git_remote_s3.remote import main
+from git_remote_s3.common import DOWNLOAD_TRANSFER_CONFIG, S3_CONFIG
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
-import tempfile
+import pytest
 import datetime
-import botocore
+import functools
+import os
+import threading
 
 SHA1 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8a"
 SHA2 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8b"
 INVALID_SHA = "z45"
-BUNDLE_SUFFIX = ".bundle"
 MOCK_BUNDLE_CONTENT = b"MOCK_BUNDLE_CONTENT"
-ARCHIVE_SUFFIX = ".zip"
 MOCK_ARCHIVE_CONTENT = b"MOCK_ARCHIVE_CONTENT"
 BRANCH = "pytest"
+HEAD_BODY = b"refs/heads/" + BRANCH.encode()
+LAST_MODIFIED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def s3_remote(session_client_mock):
+    return S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+
+
+@pytest.fixture(scope="session")
+def bundle_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("bundles") / f"{SHA1}.bundle"
+    path.write_bytes(MOCK_BUNDLE_CONTENT)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def archive_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("archives") / "repo.zip"
+    path.write_bytes(MOCK_ARCHIVE_CONTENT)
+    return str(path)
+
+
+def head_body_factory(payload=HEAD_BODY):
+    # a fresh stream for each get_object call, a read exhausts the previous one
+    return lambda **kwargs: {"Body": BytesIO(payload)}
+
+
+@functools.lru_cache(maxsize=None)
+def list_contents(shas, protected, no_head, branch):
+    keys = [f"test_prefix/refs/heads/{branch}/{s}.bundle" for s in shas]
+    if protected:
+        keys.append(f"test_prefix/refs/heads/{branch}/PROTECTED#")
+    if not no_head:
+        keys.append("test_prefix/HEAD")
+    return tuple({"Key": k, "LastModified": LAST_MODIFIED} for k in keys)
 
 
 def create_list_objects_v2_mock(
@@ -24,511 +62,522 @@ def create_list_objects_v2_mock(
     branch=BRANCH,
     shas,
 ):
-    def s3_list_objects_v2_mock(Prefix, **kwargs):
-        content = []
-        for s in shas:
-            content.append(
-                {
-                    "Key": f"test_prefix/refs/heads/{branch}/{s}.bundle",
-                    "LastModified": datetime.datetime.now(),
-                }
-            )
-        if protected:
-            content.append(
-                {
-                    "Key": f"test_prefix/refs/heads/{branch}/PROTECTED#",
-                    "LastModified": datetime.datetime.now(),
-                }
-            )
-        if not no_head:
-            content.append(
-                {
-                    "Key": "test_prefix/HEAD",
-                    "LastModified": datetime.datetime.now(),
-                }
-            )
-        return {
-            "Contents": [c for c in content if c["Key"].startswith(Prefix)],
-            "NextContinuationToken": None,
-        }
-
-    return s3_list_objects_v2_mock
-
-
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_list(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    contents = list_contents(tuple(shas), protected, no_head, branch)
+    return lambda Prefix, **kwargs: {
+        "Contents": [c for c in contents if c["Key"].startswith(Prefix)],
+        "NextContinuationToken": None,
+    }
+
+
+def mock_list_paginator(session_client_mock):
+    s3_client_mock = session_client_mock.return_value
+
+    # serve a single page from the list_objects_v2 mock
+    def paginate(**kwargs):
+        return [s3_client_mock.list_objects_v2(**kwargs)]
+
+    s3_client_mock.get_paginator.return_value.paginate.side_effect = paginate
+
+
+def test_init_sends_no_request(session_client_mock):
+    S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    assert session_client_mock.return_value.mock_calls == []
+
+
+def test_cmd_list(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA1])
     )
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
+    session_client_mock.return_value.head_bucket.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(b"refs/heads/%b" % str.encode(BRANCH))
-    }
-    s3_remote.cmd_list()
+    session_client_mock.return_value.get_object.side_effect = head_body_factory()
+    s3_remote.cmd_list("list")
     assert (
         f"@refs/heads/{BRANCH} HEAD\n{SHA1} refs/heads/{BRANCH}\n\n"
-        == stdout_mock.getvalue()
+        == capsys.readouterr().out
     )
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_list_refs(session_client_mock, stdout_mock):
+def test_list_refs(session_client_mock, capsys):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "nested/test_prefix")
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.return_value = {
         "Contents": [
             {
                 "Key": f"nested/test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": f"nested/test_prefix/refs/tags/v1/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED + datetime.timedelta(days=1),
             },
         ]
     }
 
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "nested/test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
     refs = s3_remote.list_refs(bucket=s3_remote.bucket, prefix=s3_remote.prefix)
-    assert len(refs) == 2
-    assert f"refs/heads/{BRANCH}/{SHA1}.bundle" in refs
-    assert f"refs/tags/v1/{SHA1}.bundle" in refs
+    paginator_mock = session_client_mock.return_value.get_paginator.return_value
+    paginator_mock.paginate.assert_called_once_with(
+        Bucket="test_bucket", Prefix="nested/test_prefix/refs/"
+    )
+    s3_remote.list_refs(bucket=s3_remote.bucket, prefix=s3_remote.prefix)
+    session_client_mock.return_value.get_paginator.assert_called_once_with(
+        "list_objects_v2"
+    )
+    # most recent first
+    assert refs == [
+        f"refs/tags/v1/{SHA1}.bundle",
+        f"refs/heads/{BRANCH}/{SHA1}.bundle",
+    ]
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_list_nested_prefix(session_client_mock, stdout_mock):
+def test_cmd_list_nested_prefix(session_client_mock, capsys):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "nested/test_prefix")
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.return_value = {
         "Contents": [
             {
                 "Key": f"nested/test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": "nested/test_prefix/HEAD",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
         ]
     }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "nested/test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(b"refs/heads/%b" % str.encode(BRANCH))
-    }
-    s3_remote.cmd_list()
+    session_client_mock.return_value.get_object.side_effect = head_body_factory()
+    s3_remote.cmd_list("list")
     assert (
         f"@refs/heads/{BRANCH} HEAD\n{SHA1} refs/heads/{BRANCH}\n\n"
-        == stdout_mock.getvalue()
+        == capsys.readouterr().out
     )
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_list_no_head(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_cmd_list_no_head(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA1], no_head=True)
     )
 
     def error(**kwargs):
-        raise botocore.exceptions.ClientError(
-            {"Error": {"Code": "NoSuchKey"}}, "get_object"
-        )
+        raise ClientError({"Error": {"Code": "NoSuchKey"}}, "get_object")
 
     session_client_mock.return_value.get_object.side_effect = error
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
-    s3_remote.cmd_list()
-    assert f"{SHA1} refs/heads/{BRANCH}\n\n" == stdout_mock.getvalue()
+    s3_remote.cmd_list("list")
+    assert f"{SHA1} refs/heads/{BRANCH}\n\n" == capsys.readouterr().out
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_list_with_head_not_exsting_ref(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_cmd_list_with_head_not_exsting_ref(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA1])
     )
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(b"refs/heads/master")
-    }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.return_value.get_object.side_effect = head_body_factory(
+        b"refs/heads/master"
+    )
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
-    s3_remote.cmd_list()
-    assert f"{SHA1} refs/heads/{BRANCH}\n\n" == stdout_mock.getvalue()
+    s3_remote.cmd_list("list")
+    assert f"{SHA1} refs/heads/{BRANCH}\n\n" == capsys.readouterr().out
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_list_protected_branch(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_cmd_list_protected_branch(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(protected=True, shas=[SHA1])
     )
 
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(b"refs/heads/%b" % str.encode(BRANCH))
-    }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.return_value.get_object.side_effect = head_body_factory()
+    session_client_mock.assert_called_once_with("s3", config=S3_CONFIG)
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
-    s3_remote.cmd_list()
+    s3_remote.cmd_list("list")
     assert (
         f"@refs/heads/{BRANCH} HEAD\n{SHA1} refs/heads/{BRANCH}\n\n"
-        == stdout_mock.getvalue()
+        == capsys.readouterr().out
     )
 
 
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_no_force_unprotected_ancestor(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+@pytest.mark.parametrize(
+    "uri_scheme,force,protected,shas,ancestor,empty_bucket,uploads,puts,deletes",
+    [
+        pytest.param(
+            UriScheme.S3, False, True, [SHA1], True, False, 1, 0, 1,
+            id="no_force_unprotected_ancestor",
+        ),
+        pytest.param(
+            UriScheme.S3_ZIP, False, True, [SHA1], True, False, 2, 0, 1,
+            id="no_force_unprotected_ancestor_s3_zip",
+        ),
+        pytest.param(
+            UriScheme.S3, False, False, [SHA2], False, False, 0, 0, 0,
+            id="no_force_unprotected_no_ancestor",
+        ),
+        pytest.param(
+            UriScheme.S3, True, False, [SHA2], False, False, 1, 0, 1,
+            id="force_no_ancestor",
+        ),
+        pytest.param(
+            UriScheme.S3_ZIP, True, False, [SHA2], False, False, 2, 0, 1,
+            id="force_no_ancestor_s3_zip",
+        ),
+        pytest.param(
+            UriScheme.S3, True, True, [SHA2], False, False, 0, 0, 0,
+            id="force_no_ancestor_protected",
+        ),
+        pytest.param(
+            UriScheme.S3, False, False, [], False, True, 1, 1, 0,
+            id="empty_bucket",
+        ),
+        pytest.param(
+            UriScheme.S3_ZIP, False, False, [], False, True, 2, 1, 0,
+            id="empty_bucket_s3_zip",
+        ),
+    ],
+)  # fmt: skip
+def test_cmd_push(
+    git_stub,
+    session_client_mock,
+    bundle_path,
+    archive_path,
+    uri_scheme,
+    force,
+    protected,
+    shas,
+    ancestor,
+    empty_bucket,
+    uploads,
+    puts,
+    deletes,
 ):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
-    session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(protected=True, shas=[SHA1])
+    s3_remote = S3Remote(uri_scheme, None, "test_bucket", "test_prefix")
+    git_stub.rev_parse.return_value = SHA1
+    git_stub.bundle.return_value = bundle_path
+    git_stub.archive.return_value = archive_path
+    git_stub.is_ancestor.return_value = ancestor
+    s3_client_mock = session_client_mock.return_value
+    s3_client_mock.list_objects_v2.side_effect = create_list_objects_v2_mock(
+        protected=protected, no_head=empty_bucket, shas=shas
     )
-    is_ancestor_mock.return_value = True
-    assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 1
-    assert session_client_mock.return_value.delete_object.call_count == 1
-    assert res == (f"ok refs/heads/{BRANCH}\n")
-
-
-@patch("git_remote_s3.git.archive")
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_no_force_unprotected_ancestor_s3_zip(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, archive_mock
-):
-    s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
-
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+    if empty_bucket:
+        s3_client_mock.head_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "head_object"
+        )
 
-    session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(protected=True, shas=[SHA1])
+    res = s3_remote.cmd_push(
+        f"push {'+' if force else ''}refs/heads/{BRANCH}:refs/heads/{BRANCH}"
     )
 
-    is_ancestor_mock.return_value = True
-
-    assert s3_remote.s3 == session_client_mock.return_value
-
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 2
-    assert session_client_mock.return_value.delete_object.call_count == 1
-    assert res == (f"ok refs/heads/{BRANCH}\n")
+    assert res.startswith("ok" if uploads else "error")
+    assert git_stub.bundle.call_count == (1 if uploads else 0)
+    s3_client_mock.list_objects_v2.assert_called_once_with(
+        Bucket="test_bucket", Prefix=f"test_prefix/refs/heads/{BRANCH}/"
+    )
+    keys = [c.args[2] for c in s3_client_mock.upload_file.mock_calls]
+    assert (
+        keys
+        == [
+            f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+            f"test_prefix/refs/heads/{BRANCH}/repo.zip",
+        ][:uploads]
+    )
+    for c in s3_client_mock.upload_file.mock_calls:
+        assert c.kwargs["Config"].max_concurrency == 16
+    assert s3_client_mock.put_object.call_count == puts
+    assert s3_client_mock.delete_object.call_count == deletes
 
 
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_no_force_unprotected_no_ancestor(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
-):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+def test_cmd_push_multiple_heads(git_stub, session_client_mock, s3_remote, bundle_path):
+    git_stub.rev_parse.return_value = SHA1
+    git_stub.bundle.return_value = bundle_path
     session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(shas=[SHA2])
+        create_list_objects_v2_mock(shas=[SHA1, SHA2])
     )
-
-    is_ancestor_mock.return_value = False
+    git_stub.is_ancestor.return_value = False
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    assert session_client_mock.return_value.upload_file.call_count == 0
     assert session_client_mock.return_value.put_object.call_count == 0
     assert session_client_mock.return_value.delete_object.call_count == 0
     assert res.startswith("error")
 
 
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_force_no_ancestor(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
-):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+def test_cmd_push_unknown_ref(git_stub, session_client_mock, s3_remote):
+    git_stub.rev_parse.side_effect = GitError("unknown revision")
     session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(shas=[SHA2])
+        create_list_objects_v2_mock(shas=[SHA1])
     )
-    is_ancestor_mock.return_value = False
-    assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push +refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 1
-    assert session_client_mock.return_value.delete_object.call_count == 1
-    assert res.startswith("ok")
-
-
-@patch("git_remote_s3.git.archive")
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_force_no_ancestor_s3_zip(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, archive_mock
-):
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    git_stub.bundle.assert_not_called()
+    assert res == f'error refs/heads/{BRANCH} "refs/heads/{BRANCH} not found"?\n'
+
+
+def test_cmd_push_s3_zip_upload_fails(git_stub, session_client_mock, bundle_path):
     s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
+    git_stub.rev_parse.return_value = SHA1
+    git_stub.bundle.return_value = bundle_path
+    s3_client_mock = session_client_mock.return_value
+    s3_client_mock.list_objects_v2.side_effect = create_list_objects_v2_mock(shas=[])
+    upload_failed = threading.Event()
+    archived = []
+
+    # the archive is still being built when the upload of the bundle fails
+    def archive(folder, ref):
+        assert upload_failed.wait(timeout=5)
+        archived.append(folder)
+        return f"{folder}/repo.zip"
+
+    def upload_file(*args, **kwargs):
+        upload_failed.set()
+        raise S3UploadFailedError("upload failed")
+
+    git_stub.archive.side_effect = archive
+    s3_client_mock.upload_file.side_effect = upload_file
 
-    rev_parse_mock.return_value = SHA1
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    assert res.startswith("error")
+    # the archive was awaited, then its folder removed
+    assert len(archived) == 1
+    assert not os.path.exists(archived[0])
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
 
+def test_push_batch(git_stub, session_client_mock, s3_remote, bundle_path, capsys):
+    git_stub.bundle.return_value = bundle_path
+    git_stub.rev_parse.side_effect = lambda ref: SHA1 if ref.endswith(BRANCH) else SHA2
     session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(shas=[SHA2])
+        create_list_objects_v2_mock(shas=[])
     )
+    s3_remote.process_cmd(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}\n")
+    s3_remote.process_cmd("push refs/heads/other:refs/heads/other\n")
+    assert session_client_mock.return_value.upload_file.call_count == 0
+    s3_remote.process_cmd("\n")
 
-    is_ancestor_mock.return_value = False
-
-    assert s3_remote.s3 == session_client_mock.return_value
-
-    res = s3_remote.cmd_push(f"push +refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 2
-    assert session_client_mock.return_value.delete_object.call_count == 1
-    assert res.startswith("ok")
+    assert session_client_mock.return_value.upload_file.call_count == 2
+    # the parts of the two uploads in flight fit in the connection pool
+    for c in session_client_mock.return_value.upload_file.mock_calls:
+        assert 2 * c.kwargs["Config"].max_concurrency <= S3_CONFIG.max_pool_connections
+    assert capsys.readouterr().out == f"ok refs/heads/{BRANCH}\nok refs/heads/other\n\n"
 
 
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_force_no_ancestor_protected(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+def test_push_batch_head_is_first_ref(
+    git_stub, session_client_mock, s3_remote, bundle_path, capsys
 ):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
-    session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(protected=True, shas=[SHA2])
+    git_stub.bundle.return_value = bundle_path
+    git_stub.rev_parse.side_effect = lambda ref: SHA1 if ref.endswith(BRANCH) else SHA2
+    s3_client_mock = session_client_mock.return_value
+    s3_client_mock.list_objects_v2.side_effect = create_list_objects_v2_mock(
+        no_head=True, shas=[]
     )
-    is_ancestor_mock.return_value = False
-    assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push +refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 0
-    assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("error")
-
-
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_empty_bucket(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
-):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
-
-    session_client_mock.return_value.head_object.side_effect = ClientError(
+    s3_client_mock.head_object.side_effect = ClientError(
         {"Error": {"Code": "NoSuchKey"}}, "head_object"
     )
+    other_uploaded = threading.Event()
+
+    # the first ref finishes uploading after the second one
+    def upload_file(file_path, bucket, key, **kwargs):
+        if f"/{BRANCH}/" in key:
+            assert other_uploaded.wait(timeout=5)
+        else:
+            other_uploaded.set()
+
+    s3_client_mock.upload_file.side_effect = upload_file
+    s3_remote.process_cmd(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}\n")
+    s3_remote.process_cmd("push refs/heads/zz:refs/heads/zz\n")
+    s3_remote.process_cmd("\n")
+
+    s3_client_mock.put_object.assert_called_once_with(
+        Bucket="test_bucket", Key="test_prefix/HEAD", Body=f"refs/heads/{BRANCH}"
+    )
+    assert capsys.readouterr().out == f"ok refs/heads/{BRANCH}\nok refs/heads/zz\n\n"
 
-    is_ancestor_mock.return_value = False
-    assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 2
-    assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("ok")
 
+def test_cmd_push_sets_head_once(git_stub, session_client_mock, s3_remote, bundle_path):
+    git_stub.rev_parse.return_value = SHA1
+    git_stub.bundle.return_value = bundle_path
+    s3_client_mock = session_client_mock.return_value
+    s3_client_mock.list_objects_v2.side_effect = create_list_objects_v2_mock(
+        no_head=True, shas=[]
+    )
+    s3_client_mock.head_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "head_object"
+    )
 
-@patch("git_remote_s3.git.archive")
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_empty_bucket_s3_zip(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, archive_mock
-):
-    s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
+    s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    s3_remote.cmd_push("push refs/heads/other:refs/heads/other")
 
-    rev_parse_mock.return_value = SHA1
+    assert s3_client_mock.head_object.call_count == 1
+    s3_client_mock.put_object.assert_called_once_with(
+        Bucket="test_bucket", Key="test_prefix/HEAD", Body=f"refs/heads/{BRANCH}"
+    )
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+def list_large_bundles(session_client_mock, s3_remote, shas):
+    # git lists the refs, and the size of their bundles, before fetching them
+    mock_list_paginator(session_client_mock)
+    session_client_mock.return_value.list_objects_v2.return_value = {
+        "Contents": [
+            {
+                "Key": f"test_prefix/refs/heads/{BRANCH}/{sha}.bundle",
+                "LastModified": LAST_MODIFIED,
+                "Size": 100 * 1024 * 1024,
+            }
+            for sha in shas
+        ]
+    }
+    s3_remote.list_refs(bucket=s3_remote.bucket, prefix=s3_remote.prefix)
 
-    session_client_mock.return_value.head_object.side_effect = ClientError(
-        {"Error": {"Code": "NoSuchKey"}}, "head_object"
-    )
 
-    is_ancestor_mock.return_value = False
+def test_cmd_fetch(git_stub, session_client_mock, s3_remote):
+    s3_client_mock = session_client_mock.return_value
+    s3_client_mock.get_object.side_effect = head_body_factory(MOCK_BUNDLE_CONTENT)
+    bundles = []
 
-    assert s3_remote.s3 == session_client_mock.return_value
+    def unbundle(folder, sha, ref):
+        with open(f"{folder}/{sha}.bundle", "rb") as f:
+            bundles.append(f.read())
 
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 3
-    assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("ok")
+    git_stub.unbundle.side_effect = unbundle
 
+    s3_remote.cmd_fetch(f"fetch {SHA1} refs/heads/{BRANCH}")
 
-@patch("git_remote_s3.git.is_ancestor")
-@patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
-@patch("boto3.Session.client")
-def test_cmd_push_multiple_heads(
-    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
-):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
-    session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(shas=[SHA1, SHA2])
+    # a bundle of unknown size is fetched with a single request
+    s3_client_mock.get_object.assert_called_once_with(
+        Bucket="test_bucket", Key=f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle"
     )
-    is_ancestor_mock.return_value = False
-    assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 0
-    assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("error")
+    s3_client_mock.download_file.assert_not_called()
+    s3_client_mock.head_object.assert_not_called()
+    assert bundles == [MOCK_BUNDLE_CONTENT]
 
 
-@patch("git_remote_s3.git.unbundle")
-@patch("boto3.Session.client")
-def test_cmd_fetch(session_client_mock, unbundle_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(MOCK_BUNDLE_CONTENT)
-    }
+def test_cmd_fetch_large_bundle(git_stub, session_client_mock, s3_remote):
+    list_large_bundles(session_client_mock, s3_remote, [SHA1])
+
     s3_remote.cmd_fetch(f"fetch {SHA1} refs/heads/{BRANCH}")
 
-    unbundle_mock.assert_called_once()
-    assert session_client_mock.return_value.get_object.call_count == 1
+    git_stub.unbundle.assert_called_once()
+    session_client_mock.return_value.get_object.assert_not_called()
+    download_file_mock = session_client_mock.return_value.download_file
+    assert download_file_mock.call_count == 1
+    bucket, key, file_name = download_file_mock.call_args.args
+    assert bucket == "test_bucket"
+    assert key == f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle"
+    assert file_name.endswith(f"/{SHA1}.bundle")
+    assert download_file_mock.call_args.kwargs["Config"] == DOWNLOAD_TRANSFER_CONFIG
 
 
-@patch("git_remote_s3.git.unbundle")
-@patch("boto3.Session.client")
-def test_cmd_fetch_same_ref(session_client_mock, unbundle_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    session_client_mock.return_value.get_object.return_value = {
-        "Body": BytesIO(MOCK_BUNDLE_CONTENT)
-    }
+def test_cmd_fetch_same_ref(git_stub, session_client_mock, s3_remote):
+    session_client_mock.return_value.get_object.side_effect = head_body_factory(
+        MOCK_BUNDLE_CONTENT
+    )
     s3_remote.cmd_fetch(f"fetch {SHA1} refs/heads/{BRANCH}")
     s3_remote.cmd_fetch(f"fetch {SHA1} refs/heads/{BRANCH}")
-    unbundle_mock.assert_called_once()
+    git_stub.unbundle.assert_called_once()
     assert session_client_mock.return_value.get_object.call_count == 1
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_option(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_cmd_fetch_batch(git_stub, session_client_mock, s3_remote, capsys):
+    session_client_mock.return_value.get_object.side_effect = head_body_factory(
+        MOCK_BUNDLE_CONTENT
+    )
+    s3_remote.process_cmd(f"fetch {SHA1} refs/heads/{BRANCH}\n")
+    s3_remote.process_cmd(f"fetch {SHA2} refs/heads/other\n")
+    s3_remote.process_cmd(f"fetch {SHA2} refs/heads/other\n")
+    assert git_stub.unbundle.call_count == 0
+    s3_remote.process_cmd("\n")
+
+    assert git_stub.unbundle.call_count == 2
+    assert session_client_mock.return_value.get_object.call_count == 2
+    assert capsys.readouterr().out == "\n"
+
+
+def test_cmd_fetch_batch_connection_pool(git_stub, session_client_mock, s3_remote):
+    shas = [f"{i:040x}" for i in range(20)]
+    list_large_bundles(session_client_mock, s3_remote, shas)
+    for sha in shas:
+        s3_remote.process_cmd(f"fetch {sha} refs/heads/{BRANCH}\n")
+    s3_remote.process_cmd("\n")
+
+    download_file_mock = session_client_mock.return_value.download_file
+    assert download_file_mock.call_count == len(shas)
+    # 16 bundles are downloaded at the same time, their ranged GETs in flight
+    # fit in the connection pool
+    for c in download_file_mock.mock_calls:
+        assert 16 * c.kwargs["Config"].max_concurrency <= S3_CONFIG.max_pool_connections
+
+
+def test_cmd_option(s3_remote, capsys):
     s3_remote.cmd_option("option verbosity 2")
-    assert stdout_mock.getvalue().startswith("ok\n")
+    assert capsys.readouterr().out == "ok\n"
     s3_remote.cmd_option("option concurrency 1")
-    assert stdout_mock.getvalue().endswith("unsupported\n")
+    assert capsys.readouterr().out == "unsupported\n"
 
 
-@patch("sys.stdout", new_callable=StringIO)
-@patch("boto3.Session.client")
-def test_cmd_capabilities(session_client_mock, stdout_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
-    s3_remote.cmd_capabilities()
-    assert "fetch" in stdout_mock.getvalue()
-    assert "option" in stdout_mock.getvalue()
-    assert "push" in stdout_mock.getvalue()
+def test_cmd_capabilities(s3_remote, capsys):
+    s3_remote.cmd_capabilities("capabilities")
+    out = capsys.readouterr().out
+    assert "fetch" in out
+    assert "option" in out
+    assert "push" in out
 
 
-@patch("boto3.Session.client")
-def test_cmd_push_delete(session_client_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_process_cmd_list_for_push(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[SHA1])
+    )
+    s3_remote.process_cmd("list for-push\n")
+    session_client_mock.return_value.get_object.assert_not_called()
+    assert capsys.readouterr().out == f"{SHA1} refs/heads/{BRANCH}\n\n"
+
+
+def test_process_cmd_invalid(s3_remote, capsys):
+    with pytest.raises(SystemExit):
+        s3_remote.process_cmd("unknown\n")
+    assert capsys.readouterr().err == "fatal: invalid command 'unknown\n'\n"
 
+
+def test_cmd_push_delete(session_client_mock, s3_remote):
     session_client_mock.return_value.list_objects_v2.return_value = {
         "Contents": [
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             }
         ]
     }
+    session_client_mock.return_value.delete_objects.return_value = {}
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.delete_object.call_count == 1
+    assert session_client_mock.return_value.delete_objects.call_count == 1
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
 
-@patch("boto3.Session.client")
 def test_cmd_push_delete_s3_zip(session_client_mock):
     s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
 
@@ -536,43 +585,71 @@ def test_cmd_push_delete_s3_zip(session_client_mock):
         "Contents": [
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/repo.zip",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
         ]
     }
+    session_client_mock.return_value.delete_objects.return_value = {}
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.delete_object.call_count == 2
+    session_client_mock.return_value.delete_objects.assert_called_once_with(
+        Bucket="test_bucket",
+        Delete={
+            "Objects": [
+                {"Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle"},
+                {"Key": f"test_prefix/refs/heads/{BRANCH}/repo.zip"},
+            ],
+            "Quiet": True,
+        },
+    )
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
 
-@patch("boto3.Session.client")
-def test_cmd_push_delete_fails_with_multiple_heads(session_client_mock):
-    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+def test_cmd_push_delete_error(session_client_mock, s3_remote):
+    session_client_mock.return_value.list_objects_v2.return_value = {
+        "Contents": [
+            {
+                "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+                "LastModified": LAST_MODIFIED,
+            }
+        ]
+    }
+    session_client_mock.return_value.delete_objects.return_value = {
+        "Errors": [
+            {
+                "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+                "Code": "AccessDenied",
+                "Message": "Access Denied",
+            }
+        ]
+    }
+    res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
+    assert res == f'error refs/heads/{BRANCH} "Access Denied"?\n'
+
 
+def test_cmd_push_delete_fails_with_multiple_heads(session_client_mock, s3_remote):
     session_client_mock.return_value.list_objects_v2.return_value = {
         "Contents": [
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA2}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
         ]
     }
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.delete_object.call_count == 0
+    assert session_client_mock.return_value.delete_objects.call_count == 0
     assert res.startswith("error")
 
 
-@patch("boto3.Session.client")
 def test_cmd_push_delete_fails_with_multiple_heads_s3_zip(session_client_mock):
     s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
 
@@ -580,19 +657,59 @@ def test_cmd_push_delete_fails_with_multiple_heads_s3_zip(session_client_mock):
         "Contents": [
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA2}.bundle",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/repo.zip",
-                "LastModified": datetime.datetime.now(),
+                "LastModified": LAST_MODIFIED,
             },
         ]
     }
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.delete_object.call_count == 0
+    assert session_client_mock.return_value.delete_objects.call_count == 0
     assert res.startswith("error")
+
+
+def test_cmd_list_filters_invalid_bundles(session_client_mock, s3_remote, capsys):
+    mock_list_paginator(session_client_mock)
+
+    session_client_mock.return_value.list_objects_v2.return_value = {
+        "Contents": [
+            {
+                "Key": f"test_prefix/refs/heads/feature/{BRANCH}/{SHA1}.bundle",
+                "LastModified": LAST_MODIFIED,
+            },
+            {
+                "Key": f"test_prefix/refs/heads/{BRANCH}/{INVALID_SHA}.bundle",
+                "LastModified": LAST_MODIFIED,
+            },
+            {
+                "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA2}xbundle",
+                "LastModified": LAST_MODIFIED,
+            },
+        ]
+    }
+    # HEAD points to a ref whose bundles are all invalid
+    session_client_mock.return_value.get_object.side_effect = head_body_factory()
+    s3_remote.cmd_list("list")
+    assert f"{SHA1} refs/heads/feature/{BRANCH}\n\n" == capsys.readouterr().out
+
+
+def test_main_bucket_not_found(session_client_mock, monkeypatch, capsys):
+    monkeypatch.setattr("sys.stdin", StringIO("list\n"))
+    monkeypatch.setattr(
+        "sys.argv", ["git-remote-s3", "origin", "s3://test-bucket/test_prefix"]
+    )
+    paginator = session_client_mock.return_value.get_paginator.return_value
+    paginator.paginate.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchBucket"}}, "ListObjectsV2"
+    )
+    with pytest.raises(SystemExit) as e:
+        main()
+    assert e.value.code == 1
+    assert capsys.readouterr().err == "fatal: bucket not found test-bucket\n"